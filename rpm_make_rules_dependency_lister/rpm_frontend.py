@@ -9,8 +9,14 @@
 # Creation: May 2018
 #
 
-import getopt, sys, os, subprocess, hashlib
-import pkg_resources  # part of setuptools
+import getopt, sys, os, subprocess, hashlib, mmap, sqlite3, tempfile, queue
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import rpm  # Python bindings of librpm (optional): when missing the "rpm" utility is used instead
+except ImportError:
+    rpm = None
 
 ##
 ## GLOBALS
@@ -18,18 +24,109 @@ import pkg_resources  # part of setuptools
 
 verbose = False
 
+# files between MIN_MMAP_SIZE and MAX_MMAP_SIZE are mmap'ed and hashed directly from the page cache;
+# larger files are hashed with a read loop (to avoid exhausting the address space on 32bit systems),
+# which uses buffers of HASH_BLOCK_SIZE bytes
+MIN_MMAP_SIZE = 1024 * 1024
+MAX_MMAP_SIZE = 512 * 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# IMPORTANT: GNU make dependencies cannot contain SPACES, at least in all GNU make versions <= 3.82;
+#            to work around this issue a smart way to proceed is just putting the ? wildcard instead of
+#            blanks; the characters having a special meaning for make ($ and #) are escaped instead
+MAKE_ESCAPE_TABLE = str.maketrans({' ': '?', '\t': '?', '$': '$$', '#': '\\#'})
+
+# directories holding version control metadata: they are never walked, since they contain
+# lots of files (e.g. the .git object store) which can never be the source of packaged files
+VCS_METADATA_DIRS = frozenset([".git", ".hg", ".svn", ".bzr"])
+
+# when several search directories are walked in parallel, files found by each walker thread
+# are handed over to the hashing stage in batches of this size
+SCAN_BATCH_SIZE = 256
+
 ##
 ## FUNCTIONS
 ##
 
+def new_hash_object(algorithm):
+    """Returns a new hashlib object for the given algorithm, flagged as not used for security purposes:
+       checksums are used here just to tell whether two files have the same contents, and this allows
+       MD5 to be used also on FIPS-enabled systems.
+    """
+    try:
+        return hashlib.new(algorithm, usedforsecurity=False)
+    except TypeError:
+        return hashlib.new(algorithm)    # Python < 3.9
+
+def file_object_checksum(f, algorithm):
+    """Computes the hex digest of an already-opened binary file using the given hashlib algorithm.
+       Large files (e.g. shared libraries) are mmap'ed and handed to hashlib in a single update() call:
+       data is digested straight from the page cache, without being copied into Python buffers.
+       Smaller files are hashed by hashlib.file_digest() (Python >= 3.11), which runs the whole
+       read/update loop in C; on older Pythons they are mmap'ed as well.
+       Files that cannot be mmap'ed (empty, too large or not mappable) are read in large blocks
+       into a single reusable buffer, so that no new bytes object is allocated per block.
+    """
+    has_file_digest = hasattr(hashlib, "file_digest")
+    size = os.fstat(f.fileno()).st_size
+    if 0 < size <= MAX_MMAP_SIZE and (size >= MIN_MMAP_SIZE or not has_file_digest):
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                    mm.madvise(mmap.MADV_WILLNEED)
+                hash_obj = new_hash_object(algorithm)
+                hash_obj.update(mm)
+            return hash_obj.hexdigest()
+        except (ValueError, OSError):
+            pass    # not mappable: fall back to the read loop
+    
+    if has_file_digest:
+        return hashlib.file_digest(f, lambda: new_hash_object(algorithm)).hexdigest()
+    
+    hash_obj = new_hash_object(algorithm)
+    buf = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buf)
+    while True:
+        nread = f.readinto(buf)
+        if not nread:
+            break
+        hash_obj.update(view[:nread])
+    return hash_obj.hexdigest()
+
+def open_for_hashing(filename):
+    """Opens a file on disk for reading it sequentially and returns a binary file object.
+       On Linux the file is opened with O_NOATIME, so that hashing a large tree does not cause an
+       atime update (and the associated metadata write-back) per file; O_NOATIME is permitted only
+       to the owner of the file, so in case of EPERM the file is opened again without it.
+       The kernel is also advised that the file will be read sequentially, to maximize read-ahead.
+    """
+    flags = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0)
+    noatime = getattr(os, "O_NOATIME", 0)
+    try:
+        fd = os.open(filename, flags | noatime)
+    except PermissionError:
+        if not noatime:
+            raise
+        fd = os.open(filename, flags)
+    
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass    # just a hint
+    try:
+        return os.fdopen(fd, 'rb')
+    except OSError:
+        os.close(fd)
+        raise
+
 def md5_checksum(fname):
     """Computes the MD5 hash of a file on disk
     """
-    hash_md5 = hashlib.md5()
     try:
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
+        with open_for_hashing(fname) as f:
+            return file_object_checksum(f, "md5")
     except OSError:
         # this happens when a directory is encountered
         return ""
@@ -40,60 +137,174 @@ def md5_checksum(fname):
         print("Failed opening decompressed file '{}'\n".format(fname))
         sys.exit(3)
 
-    return hash_md5.hexdigest()
-
-def sha256_checksum(filename, block_size=65536):
+def sha256_checksum(filename):
     """Computes the SHA256 hash of a file on disk
     """
-    sha256 = hashlib.sha256()
     try:
-        with open(filename, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                sha256.update(block)
+        with open_for_hashing(filename) as f:
+            return file_object_checksum(f, "sha256")
     except OSError:
         # this happens when a directory is encountered
         return ""
     except FileNotFoundError:
         # this happens when a BROKEN symlink on the system matches the name of a file packaged inside an RPM
         return ""
-    return sha256.hexdigest()
 
-def get_permissions_safe(filename):
+# the digest algorithm of packaged files is told apart by the length of their hex checksum:
+# SHA256 is the rpmbuild default, MD5 is used only by legacy RPMs
+CHECKSUM_FUNCTIONS_BY_LENGTH = {
+    64: (sha256_checksum, "sha256"),
+    32: (md5_checksum, "md5"),
+}
+
+def get_stat_safe(entry):
+    """Returns the stat() result for the file of the given os.DirEntry or None; the result is cached
+       inside the DirEntry so it can be reused later without additional syscalls.
+    """
     try:
-        return os.stat(filename).st_mode
-    except FileNotFoundError as e:
+        return entry.stat()
+    except OSError:
         # this happens when a BROKEN symlink on the system matches the name of a file packaged inside an RPM
-        if verbose:
-            print("   Cannot stat the filename '{}': {}".format(filename, str(e)))
-        return 0 # do not exit!
-
-def is_executable(permission_int):
-    """Takes a number containing a Unix file permission mode (as reported by RPM utility)
-       and returns True if the file has executable bit set.
-       
-       NOTE: for some reason the modes returned by RPM utility are beyond 777 octal number...
-             so we throw away the additional bits
+        return None
+
+def scan_directory_tree(abs_dir):
+    """Recursively lists the contents of the given directory using an iterative os.scandir()
+       traversal: the type of each entry comes from the directory listing itself, so no
+       additional stat() is required to tell files apart from directories.
+       Yields (dirname, os.DirEntry) tuples for all entries that are not directories;
+       just like os.walk(), symlinks to directories are not followed and unreadable
+       directories are silently skipped; version control metadata directories are skipped too.
     """
-    executable_flag = 0x49  # 0x49 is equal to 0111 octal number, which is the flag for executable bits for USER,GROUP,OTHER
-    return (permission_int & executable_flag) != 0
-
-def merge_two_dicts(x, y):
-    #z = x.copy()   # start with x's keys and values
-    #z.update(y)    # modifies z with y's keys and values & returns None
-    #z = {**x, **y}
-    #print(x)
-    #print(y)
-    
-    z = {}
-    for fname,set_fullpaths in x.items():
-        z[fname]=set_fullpaths
-    for fname,set_fullpaths in y.items():
-        if fname in z:
-            for fullpath in set_fullpaths:
-                z[fname].add(fullpath)
+    stack = [abs_dir]
+    while stack:
+        dirname = stack.pop()
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in VCS_METADATA_DIRS:
+                            stack.append(entry.path)
+                    elif not entry.is_dir():
+                        yield dirname, entry
+        except OSError:
+            continue
+
+def scan_directory_trees_in_parallel(abs_dirs, wanted_fnames):
+    """Recursively lists the contents of all the given directories, walking each of them in its own thread:
+       os.scandir() releases the GIL while waiting for the filesystem, so the traversals overlap.
+       Yields (dirname, os.DirEntry) tuples, like scan_directory_tree(), but only for the entries
+       having one of the wanted filenames; the order of the results is not deterministic.
+    """
+    found_queue = queue.Queue()
+    
+    def scan_one_tree(abs_dir):
+        try:
+            batch = []
+            for dirname, entry in scan_directory_tree(abs_dir):
+                if entry.name in wanted_fnames:
+                    batch.append( (dirname, entry) )
+                    if len(batch) >= SCAN_BATCH_SIZE:
+                        found_queue.put(batch)
+                        batch = []
+            found_queue.put(batch)
+        finally:
+            found_queue.put(None)    # this walker is done
+    
+    with ThreadPoolExecutor(max_workers=min(32, len(abs_dirs))) as executor:
+        futures = [executor.submit(scan_one_tree, abs_dir) for abs_dir in abs_dirs]
+        running = len(futures)
+        while running:
+            batch = found_queue.get()
+            if batch is None:
+                running -= 1
+            else:
+                yield from batch
+        for future in futures:
+            future.result()    # re-raise any unexpected exception of the walker threads
+
+def is_walked_as_part_of(abs_dir, abs_parent_dir):
+    """Returns True if walking abs_parent_dir with scan_directory_tree() walks abs_dir as well, that is
+       if abs_dir is nested inside abs_parent_dir and no directory between the two is a symlink
+       or a version control metadata directory (scan_directory_tree() does not descend into those).
+    """
+    if not abs_dir.startswith(abs_parent_dir.rstrip(os.sep) + os.sep):
+        return False
+    path = abs_parent_dir
+    for component in os.path.relpath(abs_dir, abs_parent_dir).split(os.sep):
+        path = os.path.join(path, component)
+        if component in VCS_METADATA_DIRS or os.path.islink(path):
+            return False
+    return True
+
+def remove_overlapping_dirs(dirs):
+    """Returns the given list of directories without those that are duplicates of (i.e. resolve to the
+       same directory as), or are walked as part of, another directory of the list: walking them would
+       just find (and hash) the same files again.
+    """
+    abs_dirs = [os.path.abspath(d) for d in dirs]
+    real_dirs = [os.path.realpath(d) for d in dirs]
+    result = []
+    for i,abs_dir in enumerate(abs_dirs):
+        overlapping = False
+        for j,other_abs_dir in enumerate(abs_dirs):
+            if j == i:
+                continue
+            if real_dirs[j] == real_dirs[i]:
+                overlapping = j < i    # keep only the first occurrence of duplicates
+            else:
+                overlapping = is_walked_as_part_of(abs_dir, other_abs_dir)
+            if overlapping:
+                break
+        if overlapping:
+            if verbose:
+                print("Skipping search directory '{}' since it is already searched as part of '{}'".format(dirs[i], dirs[j]))
         else:
-            z[fname]=set_fullpaths
-    return z
+            result.append(dirs[i])
+    return result
+
+##
+## CHECKSUM CACHE
+##
+
+class ChecksumCache:
+    """Persistent cache of the checksums of files on disk, stored in a SQLite database so that
+       it can be safely shared by several instances of this utility (e.g. when running "make -j").
+       Entries are keyed by the identity of the file (device and inode numbers) and are valid only
+       as long as the file has the same mtime, ctime and size: any modification invalidates them.
+       The ctime is checked as well since, unlike the mtime, it cannot be set back by the user
+       (e.g. by "cp -p" or "touch -r" over an existing file).
+    """
+    
+    COLUMNS = ["st_dev", "st_ino", "st_mtime_ns", "st_ctime_ns", "st_size", "algorithm", "checksum"]
+    
+    def __init__(self, db_filename):
+        """Ctor"""
+        self.db = sqlite3.connect(db_filename, timeout=30)
+        with self.db:
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(checksums)")]
+            if columns and columns != self.COLUMNS:
+                # created by a different version of this utility: being just a cache, start over
+                self.db.execute("DROP TABLE checksums")
+            self.db.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                            "st_dev INTEGER, st_ino INTEGER, st_mtime_ns INTEGER, st_ctime_ns INTEGER, st_size INTEGER, "
+                            "algorithm TEXT, checksum TEXT, PRIMARY KEY (st_dev, st_ino, algorithm))")
+    
+    def get(self, st, algorithm):
+        """Returns the cached checksum for the file having the given os.stat_result, or None"""
+        row = self.db.execute("SELECT checksum FROM checksums WHERE st_dev=? AND st_ino=? AND algorithm=? "
+                              "AND st_mtime_ns=? AND st_ctime_ns=? AND st_size=?",
+                              (st.st_dev, st.st_ino, algorithm, st.st_mtime_ns, st.st_ctime_ns, st.st_size)).fetchone()
+        return row[0] if row else None
+    
+    def put_many(self, entries):
+        """Stores a list of (os.stat_result, algorithm, checksum) entries, replacing stale ones"""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?,?,?)",
+                                [(st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size, algorithm, checksum)
+                                 for st,algorithm,checksum in entries])
+    
+    def close(self):
+        self.db.close()
 
 
 ##
@@ -107,11 +318,87 @@ class RpmDependencyLister:
         self.tab_str = ' '
         self.tab_size = 4
         self.backup = False
+        self.checksum_cache = None
+        self.hash_jobs = min(32, (os.cpu_count() or 1) * 4)
+    
+    def get_file_entries_from_rpm_bindings(self, rpm_filename):
+        """Reads the list of packaged files directly from the header of an RPM file, using the
+           Python bindings of librpm: no process needs to be spawned and no text needs to be parsed.
+           Yields (filename + path, sha256sum/md5sum, permissions, size) tuples.
+        """
+        ts = rpm.TransactionSet()
+        # the RPM is not being installed: there is no need to verify its signatures/digests
+        ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)
+        try:
+            with open(rpm_filename, "rb") as f:
+                hdr = ts.hdrFromFdno(f.fileno())
+        except (OSError, rpm.error) as e:
+            print("Failed decompressing {}: {}\n".format(rpm_filename, e))
+            sys.exit(3)
+        
+        # NOTE: regardless the tag name "FILEMD5S", what is returned is actually a SHA256 in recent RPMs!
+        # NOTE2: RPMs packaging files of 4GiB or more store only LONGFILESIZES, not FILESIZES;
+        #        reading LONGFILESIZES works for all RPMs since librpm falls back to FILESIZES
+        file_arrays = (hdr[rpm.RPMTAG_FILENAMES], hdr[rpm.RPMTAG_FILEMD5S],
+                       hdr[rpm.RPMTAG_FILEMODES], hdr[rpm.RPMTAG_LONGFILESIZES])
+        if len(set(len(file_array) for file_array in file_arrays)) != 1:
+            # zip() would silently truncate the list of packaged files
+            print("Failed decompressing {}: inconsistent header (found {} filenames, {} checksums, {} modes, {} sizes)\n".format(
+                rpm_filename, *[len(file_array) for file_array in file_arrays]))
+            sys.exit(3)
+        
+        for filewithpath,checksum,permissions,size in zip(*file_arrays):
+            if isinstance(filewithpath, bytes):
+                filewithpath = filewithpath.decode("utf-8")    # older versions of the bindings return bytes
+            if isinstance(checksum, bytes):
+                checksum = checksum.decode("utf-8")
+            # file modes are 16bit values: old versions of the bindings may return them as signed integers
+            yield filewithpath, checksum, permissions & 0xFFFF, size
+    
+    def get_file_entries_from_rpm_utility(self, rpm_filename):
+        """Reads the list of packaged files from the header of an RPM file by querying it with
+           the "rpm" command line utility.
+           Yields (filename + path, sha256sum/md5sum, permissions, size) tuples.
+        """
+        # NOTE: regardless the query tag name "FILEMD5S", what is returned is actually a SHA256!
+        # NOTE2: checksums are read from the RPM header: no need to extract the RPM payload
+        # NOTE3: stderr is kept separated so that rpm warnings (e.g. about missing signature keys)
+        #        do not get mixed with the file list; it goes to a temporary file rather than to a pipe
+        #        so that rpm can never block on a full stderr pipe while we are reading its stdout
+        # NOTE4: RPMs packaging files of 4GiB or more store only LONGFILESIZES, not FILESIZES;
+        #        querying LONGFILESIZES works for all RPMs since rpm falls back to FILESIZES
+        with tempfile.TemporaryFile() as rpm_stderr:
+            try:
+                proc = subprocess.Popen(
+                    ["rpm", "-qp", "--qf", "[%{filenames},%{FILEMD5S},%{FILEMODES},%{LONGFILESIZES}\n]", rpm_filename],
+                     stdout=subprocess.PIPE,
+                     stderr=rpm_stderr)
+            except OSError as e:
+                # typically the "rpm" utility is not installed
+                print("Failed decompressing {}: {}\n".format(rpm_filename, e))
+                sys.exit(3)
+            
+            # parse the output while rpm is still producing it, without buffering all of it;
+            # split from the right since only the filename may contain commas
+            with proc.stdout:
+                for line in proc.stdout:
+                    try:
+                        filewithpath,checksum,permissions,size = line.decode("utf-8").rstrip("\n").rsplit(',', 3)
+                        permissions, size = int(permissions), int(size)
+                    except ValueError:
+                        print("Failed decompressing {}: unexpected rpm output line '{}'\n".format(rpm_filename, line.decode("utf-8", "replace").rstrip("\n")))
+                        sys.exit(3)
+                    yield filewithpath, checksum, permissions, size
+            
+            if proc.wait() != 0:
+                rpm_stderr.seek(0)
+                print("Failed decompressing {}: {}\n".format(rpm_filename, rpm_stderr.read()))
+                sys.exit(3)
     
     def get_checksum_tuples_from_rpm(self, rpm_filename):
         """Extracts sha256sums or md5sums from an RPM file and creates
            a list of N-tuples with:
-               (extracted filename + path, sha256sum/md5sum of the extracted file, permissions of extracted filename, is_executable)
+               (extracted filename + path, extracted filename only, sha256sum/md5sum of the extracted file, permissions of extracted filename, is_executable, size of extracted filename)
                
            NOTE: you can assume that if the checksum string is 32chars long it's an MD5SUM while if
                  it is 64chars long it's a SHA256SUM.
@@ -131,42 +418,114 @@ class RpmDependencyLister:
         
         # we need an absolute path since we change the CWD in the subprocess:
         assert os.path.isabs(rpm_filename)
-        try:
-            # NOTE: regardless the query tag name "FILEMD5S", what is returned is actually a SHA256!
-            rpm_checksums = subprocess.check_output(
-                "rpm -qp --qf '[%{filenames},%{FILEMD5S},%{FILEMODES}\n]' " + rpm_filename,
-                 stderr=subprocess.STDOUT,
-                 shell=True)
-        except subprocess.CalledProcessError as e:
-            print("Failed decompressing {}: {}\n".format(rpm_filename, e.output))
-            sys.exit(3)
+        if rpm:
+            rpm_file_entries = self.get_file_entries_from_rpm_bindings(rpm_filename)
+        else:
+            rpm_file_entries = self.get_file_entries_from_rpm_utility(rpm_filename)
     
-        # convert binary strings \n-separed -> string array
-        rpm_files_comma_checksums = [s.strip().decode("utf-8") for s in rpm_checksums.splitlines()]
-        
         # generate output
         retvalue = []
-        for s in rpm_files_comma_checksums:
-            filewithpath,checksum,permissions = s.split(',')
-            if len(checksum)==0:
+        isabs = os.path.isabs    # local aliases: avoid an attribute lookup per packaged file
+        basename = os.path.basename
+        for filewithpath,checksum,permissions,size in rpm_file_entries:
+            if not checksum:
                 continue    # if no checksum is present, this is a directory, skip it
-            if len(checksum)!=32 and len(checksum)!=64:
+            if len(checksum) not in (32, 64):
                 print("Found checksum of unexpected len ({} chars): {}. Expecting 32chars MD5SUMs or 64chars SHA256SUM.\n".format(len(checksum), checksum))
             
-            permissions=int(permissions)
-            
-            assert os.path.isabs(filewithpath)
-            retvalue.append( (filewithpath,checksum,permissions,is_executable(permissions)) )
+            assert isabs(filewithpath)
+            # the file is executable if any of the executable bits for USER,GROUP,OTHER (0111 octal) is set
+            retvalue.append( (filewithpath,basename(filewithpath),checksum,permissions,(permissions & 0o111) != 0,size) )
     
         if verbose:
             print("The RPM file '{}' packages a total of {} files".format(rpm_filename, len(retvalue)))
     
         return retvalue
     
-    def get_file_matches(self, rpm_fname, rpm_checksum, rpm_is_exec, filename2path_dict, filename2permission_dict, nameonly_check_for_exec_files):
+    def get_cached_checksum(self, st, algorithm):
+        """Returns the checksum of the file having the given os.stat_result from the checksum cache, if any.
+           Failing to read the cache is not fatal: the cache is just not used for the rest of the run.
+        """
+        if not self.checksum_cache:
+            return None
+        try:
+            return self.checksum_cache.get(st, algorithm)
+        except sqlite3.Error as e:
+            print("Failed reading the checksum cache: {}. Proceeding without it.".format(e))
+            self.checksum_cache.close()
+            self.checksum_cache = None
+            return None
+    
+    def compute_filesystem_checksums(self, rpm_checksum_tuples, filesystem_files, nameonly_check_for_exec_files):
+        """Computes the MD5/SHA256 sums of all files found on the local filesystem that have the same name
+           of a file packaged inside the RPM (i.e. all the candidates for a match).
+           The filesystem files are provided as an iterable of (dirname, os.DirEntry) tuples, typically
+           a generator that is still traversing the filesystem: candidates are submitted for hashing as soon
+           as they are found, so that hashing overlaps with the directory traversal.
+           Files whose size differs from the size of the packaged file are skipped since they cannot
+           possibly match: a stat() is much cheaper than reading and hashing the whole file.
+           Files are hashed by a pool of threads: hashlib releases the GIL while digesting data, so
+           disk reads and hash computations of different files overlap.
+           If a checksum cache is in use, files that did not change since a previous run are not hashed at all.
+           Files reachable through several paths (hardlinks) are hashed only once.
+           
+           Returns a dictionary {(filesystem_fullpath, checksum_length):filesystem_checksum}.
+        """
+        # index by filename all the packaged files that need to be hashed:
+        rpm_entries_by_fname = defaultdict(list)   # {filename_only:[(checksum_length, checksum_function, algorithm, size), ...]}
+        for rpm_file,rpm_fname,rpm_checksum,rpm_permission,rpm_is_exec,rpm_size in rpm_checksum_tuples:
+            if nameonly_check_for_exec_files and rpm_is_exec:
+                continue    # the match will be done on the filename only, no need to hash
+            checksum_length = len(rpm_checksum)
+            checksum_function, algorithm = CHECKSUM_FUNCTIONS_BY_LENGTH.get(checksum_length, (None, None))
+            if checksum_function is None:
+                continue    # unknown checksum algorithm, this file will never match
+            rpm_entries_by_fname[rpm_fname].append( (checksum_length, checksum_function, algorithm, rpm_size) )
+        
+        filesystem_checksums = {}
+        checksum_futures = {}   # {(filesystem_fullpath, checksum_length):future}
+        inode_futures = {}      # {(st_dev, st_ino, algorithm):(os.stat_result, future)}
+        with ThreadPoolExecutor(max_workers=self.hash_jobs) as executor:
+            for dirname,entry in filesystem_files:
+                rpm_entries = rpm_entries_by_fname.get(entry.name)
+                if not rpm_entries:
+                    continue
+                filesystem_fullpath = entry.path
+                st = get_stat_safe(entry)
+                if st is None:
+                    continue
+                
+                for checksum_length,checksum_function,algorithm,rpm_size in rpm_entries:
+                    key = (filesystem_fullpath, checksum_length)
+                    if st.st_size != rpm_size or key in filesystem_checksums or key in checksum_futures:
+                        continue
+                    
+                    inode_key = (st.st_dev, st.st_ino, algorithm)
+                    if inode_key not in inode_futures:
+                        cached_checksum = self.get_cached_checksum(st, algorithm)
+                        if cached_checksum:
+                            filesystem_checksums[key] = cached_checksum
+                            continue
+                        inode_futures[inode_key] = (st, executor.submit(checksum_function, filesystem_fullpath))
+                    checksum_futures[key] = inode_futures[inode_key][1]
+        
+        for key,future in checksum_futures.items():
+            filesystem_checksums[key] = future.result()
+        new_cache_entries = [(st,inode_key[2],future.result()) for inode_key,(st,future) in inode_futures.items() if future.result()]
+        if self.checksum_cache and new_cache_entries:
+            try:
+                self.checksum_cache.put_many(new_cache_entries)
+            except sqlite3.Error as e:
+                # not fatal: checksums will just be computed again on next run
+                print("Failed updating the checksum cache: {}".format(e))
+        
+        return filesystem_checksums
+    
+    def get_file_matches(self, rpm_fname, rpm_checksum, rpm_is_exec, filename2path_dict, filesystem_checksums, nameonly_check_for_exec_files):
         """Contains the logic that declares if a file packaged inside an RPM is matching a file
            found on the local filesystem.
-           This function requires a pre-built dictionary (hashmap) of the files scanned in the local filesystem.
+           This function requires a pre-built dictionary (hashmap) of the files scanned in the local filesystem
+           and the checksums of the candidate files, as computed by compute_filesystem_checksums().
            
            Generally the matching is done based on just the MD5/SHA256sum but in case nameonly_check_for_exec_files=True,
            then the check is relaxed and is done on just the filename, for all executable files.
@@ -178,25 +537,17 @@ class RpmDependencyLister:
             return file_matches
             
         # this RPM file has a file with the same name in the filesystem...
-        dirname_list = filename2path_dict[rpm_fname]
-        permission_list = filename2permission_dict[rpm_fname]
-        assert len(dirname_list) == len(permission_list)
-        
-        for num_entries in range(0,len(dirname_list)):
-            dirname = dirname_list[num_entries]
+        for dirname in filename2path_dict[rpm_fname]:
             filesystem_fullpath = os.path.join(dirname,rpm_fname)
-            #filesystem_permissions = permission_list[num_entries]
             
             if nameonly_check_for_exec_files and rpm_is_exec:
-                ##if is_executable(filesystem_permissions):
+                # NOTE: the permissions of the filesystem file are not checked: if that's ever needed,
+                #       stat() it here rather than during the directory traversal
                 if verbose:
                     print("   Found file '{}' in directory '{}' with same name and executable permissions of an RPM packaged file! Adding to dependency list.".format(rpm_fname, dirname))
                 file_matches.append(filesystem_fullpath)
             else:
-                if len(rpm_checksum)==32:
-                    filesystem_checksum = md5_checksum(filesystem_fullpath)
-                elif len(rpm_checksum)==64:
-                    filesystem_checksum = sha256_checksum(filesystem_fullpath)
+                filesystem_checksum = filesystem_checksums.get( (filesystem_fullpath,len(rpm_checksum)) )
                 if filesystem_checksum == rpm_checksum:
                     # ...and with the same checksum!
                     if verbose:
@@ -205,62 +556,70 @@ class RpmDependencyLister:
     
         return file_matches
     
+    def scan_search_dirs(self, abs_filesystem_dirs, filename2path_dict, wanted_fnames):
+        """Walks given filesystem directory list and fills the given defaultdict(list) with
+           the found files having one of the wanted filenames (all other files cannot possibly match):
+               {filename_only:[dirname1,...] ... }
+           This is a generator yielding a (dirname, os.DirEntry) tuple for each file as soon as it is
+           found, so that the caller can process files while the traversal is still in progress.
+           Multiple search directories are walked in parallel.
+        """
+        if len(abs_filesystem_dirs) > 1:
+            found_files = scan_directory_trees_in_parallel(abs_filesystem_dirs, wanted_fnames)
+        else:
+            found_files = ((root, entry) for abs_filesystem_dir in abs_filesystem_dirs
+                                         for root, entry in scan_directory_tree(abs_filesystem_dir)
+                                         if entry.name in wanted_fnames)
+        
+        for root, entry in found_files:
+            #print('---' + entry.path)
+            # NOTE: the same filename may be present in several directories: keep them all
+            filename2path_dict[entry.name].append(root)
+            yield root, entry
+    
     def match_checksum_tuples_with_fileystem(self, abs_filesystem_dirs, rpm_checksum_tuples, strict_mode, nameonly_check_for_exec_files):
         """Walks given filesystem directory list and searches for files matching those
            coming from an RPM packaged contents.
-           Returns a list of filesystem full paths matching RPM contents and a list of
+           Returns a dictionary of filesystem full paths matching RPM contents and a list of
            files packaged in the RPM that could not be found:
-               {filename_only:set(fullpath_to_file1,...) ... }
+               {filename_only:set(fullpath_to_file1,...) ... }, [(filename_only,checksum), ...]
         """
         
-        # traverse root directory, and create an hashmap of the found files
-        # this allows us to later search each packaged file in O(1)
-        filename2path_dict = {}
-        filename2permission_dict = {}
-        nfound = 0
-        
         for abs_filesystem_dir in abs_filesystem_dirs:
             if not os.path.isdir(abs_filesystem_dir):
                 print("No such directory '{}'".format(abs_filesystem_dir))
                 sys.exit(1)
-            for root, _, files in os.walk(abs_filesystem_dir):
-                for filename_only in files:
-                    #print('---' + root + filename_only)
-                    nfound=nfound+1
-                    permission_int = get_permissions_safe(os.path.join(root,filename_only))
-                    if filename_only in filename2path_dict:
-                        filename2path_dict[filename_only].append(root)
-                        filename2permission_dict[filename_only].append(permission_int)
-                    else:
-                        filename2path_dict[filename_only] = [root]
-                        filename2permission_dict[filename_only] = [permission_int]
+        abs_filesystem_dirs = remove_overlapping_dirs(abs_filesystem_dirs)
+        
+        # traverse root directories, and create an hashmap of the found files
+        # this allows us to later search each packaged file in O(1);
+        # while traversing, hash all candidate files in parallel:
+        filename2path_dict = defaultdict(list)
+        wanted_fnames = {rpm_checksum_tuple[1] for rpm_checksum_tuple in rpm_checksum_tuples}
+        filesystem_files = self.scan_search_dirs(abs_filesystem_dirs, filename2path_dict, wanted_fnames)
+        filesystem_checksums = self.compute_filesystem_checksums(rpm_checksum_tuples, filesystem_files, nameonly_check_for_exec_files)
                 
         if verbose:
-            print("** In folder '{}' recursively found a total of {} files".format(abs_filesystem_dir, nfound))
+            nfound = sum(len(dirname_list) for dirname_list in filename2path_dict.values())
+            print("** In folder '{}' recursively found a total of {} files named like a packaged file".format(abs_filesystem_dir, nfound))
     
         # now try to match each RPM-packaged file with a file from previous hashmap
         # This takes O(n) where N=number of packaged files
         packaged_files_notfound = []
         packaged_files_fullpath = {}
         nfound = 0
-        for rpm_file,rpm_checksum,rpm_permission,rpm_is_exec in rpm_checksum_tuples:
-            rpm_fname = os.path.basename(rpm_file)
-            packaged_files_fullpath[rpm_fname]=set()
-            
+        for rpm_file,rpm_fname,rpm_checksum,rpm_permission,rpm_is_exec,rpm_size in rpm_checksum_tuples:
             # query the dictionaries we just created and get N results back:
-            file_matches = self.get_file_matches(rpm_fname, rpm_checksum, rpm_is_exec, filename2path_dict, filename2permission_dict, nameonly_check_for_exec_files)
+            file_matches = self.get_file_matches(rpm_fname, rpm_checksum, rpm_is_exec, filename2path_dict, filesystem_checksums, nameonly_check_for_exec_files)
             if len(file_matches) == 0:
                 packaged_files_notfound.append( (rpm_fname,rpm_checksum) )
-            elif len(file_matches) == 1:
-                packaged_files_fullpath[rpm_fname].add(file_matches[0])
-                nfound=nfound+1
-            else:
-                assert len(file_matches)>1
-                # add all the multiple matches
-                for filesystem_fullpath in file_matches:
-                    packaged_files_fullpath[rpm_fname].add(filesystem_fullpath)
-                    nfound=nfound+1
-                    
+                continue
+            
+            # NOTE: several packaged files may share the same filename: accumulate their matches;
+            #       the set is created only for packaged files having at least a match
+            packaged_files_fullpath.setdefault(rpm_fname, set()).update(file_matches)
+            nfound=nfound+len(file_matches)
+            if len(file_matches) > 1:
                 if verbose:
                     # Emit a warning but keep going
                     print("   WARNING: found an RPM packaged file '{}' that has the same name and SHA256/MD5 sum of multiple files found in the filesystem:".format(rpm_fname))
@@ -273,41 +632,41 @@ class RpmDependencyLister:
                 
         if verbose:
             print("   In folder '{}' recursively found a total of {} packaged files".format(abs_filesystem_dir, nfound))
-        #return packaged_files_fullpath, packaged_files_notfound
-        return packaged_files_fullpath
+        return packaged_files_fullpath, packaged_files_notfound
     
     def generate_dependency_list(self, outfile, rpm_file, dict_matching_files, generate_empty_recipes):
         """Write a text file (typically the extension is ".d") in a format compatible with GNU
            make. The output text file, if included inside a Makefile, will instruct GNU make 
            about the dependencies of an RPM, so that such RPM can be rebuilt only when one of
            the dependencies is updated (rather than unconditionally).
+           Dependencies are listed only once and in sorted order, so that the output is reproducible
+           across runs and GNU make never stats the same file twice.
+           Returns the number of dependencies written.
         """
         #print(dict_matching_files)
-        list_of_files = []
-        for _,set_of_fullpaths in dict_matching_files.items():
-            for fullpath in set_of_fullpaths:
-                # IMPORTANT: GNU make dependencies cannot contain SPACES, at least in all GNU make versions <= 3.82;
-                #            to work around this issue a smart way to proceed is just putting the ? wildcard instead of spaces: 
-                list_of_files.append(fullpath.replace(' ', '?'))
-                
-        list_of_files = sorted(list_of_files)
-        text = rpm_file + ": \\\n\t" + " \\\n\t".join(list_of_files) + "\n"
-        
-        # According to the GNU make User’s Manual section "Rules without Recipes or Prerequisites":
-        # If a rule has no prerequisites or recipe, and the target of the rule is a nonexistent file,
-        # then `make’ imagines this target to have been updated whenever its rule is run. 
-        # This implies that all targets depending on this one will always have their recipes run.
-        if generate_empty_recipes:
-            text += "\n\n# Empty recipes for dependency files (to avoid GNU make failures on dependency file removal):\n"
-            for dep_filename in list_of_files:
-                text += dep_filename + ":\n\n"
+        list_of_files = sorted({fullpath.translate(MAKE_ESCAPE_TABLE)
+                                for fullpath in chain.from_iterable(dict_matching_files.values())})
         
+        # each dependency is encoded only once; the output is then streamed to a buffered writer chunk by chunk,
+        # without ever materializing the whole file contents in memory (RPMs may package many thousands of files)
+        deps = [os.fsencode(dep_filename) for dep_filename in list_of_files]
         try:
-            with open(outfile, "w") as f:
-                f.write(text)
-        except:
+            with open(outfile, "wb") as f:
+                f.write(os.fsencode(rpm_file) + b": \\\n\t")
+                f.writelines(dep if num == 0 else b" \\\n\t" + dep for num,dep in enumerate(deps))
+                f.write(b"\n")
+                
+                # According to the GNU make User’s Manual section "Rules without Recipes or Prerequisites":
+                # If a rule has no prerequisites or recipe, and the target of the rule is a nonexistent file,
+                # then `make’ imagines this target to have been updated whenever its rule is run. 
+                # This implies that all targets depending on this one will always have their recipes run.
+                if generate_empty_recipes:
+                    f.write(b"\n\n# Empty recipes for dependency files (to avoid GNU make failures on dependency file removal):\n")
+                    f.writelines(dep + b":\n\n" for dep in deps)
+        except (OSError, IOError):
             print("Failed writing to output file '{}'. Aborting".format(outfile))
             sys.exit(2)
+        return len(list_of_files)
     
     def generate_missed_file_list(self, outfile, rpm_file, packaged_files_notfound):
         """Write a text file with the list of packaged files that could not be found inside search folders.
@@ -343,16 +702,16 @@ class RpmDependencyLister:
         rpm_file_checksums = self.get_checksum_tuples_from_rpm(config['abs_input_rpm'])
         
         # STEP 2
-        dict_matching_files = self.match_checksum_tuples_with_fileystem(config['search_dirs'], rpm_file_checksums, config['strict'], config['nameonly_check_for_exec_files'])
-    
-        nfound = 0
-        packaged_files_notfound = []
-        for rpm_file,rpm_checksum,rpm_permission,rpm_is_exec in rpm_file_checksums:
-            rpm_fname = os.path.basename(rpm_file)
-            if rpm_fname not in dict_matching_files or len(dict_matching_files[rpm_fname])==0:
-                packaged_files_notfound.append( (rpm_fname,rpm_checksum) )
-            else:
-                nfound = nfound+1
+        if config['jobs']>0:
+            self.hash_jobs = config['jobs']
+        if len(config['checksum_cache'])>0:
+            try:
+                self.checksum_cache = ChecksumCache(config['checksum_cache'])
+            except sqlite3.Error as e:
+                print("Failed opening the checksum cache '{}': {}. Proceeding without it.".format(config['checksum_cache'], e))
+        dict_matching_files, packaged_files_notfound = self.match_checksum_tuples_with_fileystem(config['search_dirs'], rpm_file_checksums, config['strict'], config['nameonly_check_for_exec_files'])
+        if self.checksum_cache:
+            self.checksum_cache.close()
         
         # report all files not found all together at the end:
         if len(config['missed_list_outfile'])>0:
@@ -369,7 +728,7 @@ class RpmDependencyLister:
                 sys.exit(3)
                 
         if verbose:
-            print("Found a total of {} packaged files across all search folders".format(nfound))
+            print("Found a total of {} packaged files across all search folders".format(len(rpm_file_checksums)-len(packaged_files_notfound)))
                 
         input_rpm = config['input_rpm']
         if config['strip_dirname']:
@@ -388,10 +747,10 @@ class RpmDependencyLister:
                         dict_matching_files[filename_only]=set([filepath])
             
         # STEP 3: finally generate the dependency listing:
-        self.generate_dependency_list(config['output_dep'], input_rpm, dict_matching_files, config['generate_empty_recipes'])
+        ndeps = self.generate_dependency_list(config['output_dep'], input_rpm, dict_matching_files, config['generate_empty_recipes'])
     
         print("Successfully generated dependency list for '{}' in file '{}' listing {} dependencies ({} packaged files are missing)".format(
-            input_rpm, config['output_dep'], len(dict_matching_files.items()), len(packaged_files_notfound)))
+            input_rpm, config['output_dep'], ndeps, len(packaged_files_notfound)))
     
 
 
@@ -399,10 +758,22 @@ class RpmDependencyLister:
 ## MAIN
 ##
 
+def get_version():
+    """Returns the version of this package
+    """
+    try:
+        # importlib.metadata (Python >= 3.8) reads just the metadata of this distribution and, unlike
+        # pkg_resources, does not scan all installed distributions
+        from importlib.metadata import version
+    except ImportError:
+        import pkg_resources  # part of setuptools
+        return pkg_resources.require("rpm_make_rules_dependency_lister")[0].version
+    return version("rpm_make_rules_dependency_lister")
+
 def usage():
     """Provides commandline usage
     """
-    version = pkg_resources.require("rpm_make_rules_dependency_lister")[0].version
+    version = get_version()
     print('rpm_make_rules_dependency_lister version {}'.format(version))
     print('Typical usage:')
     print('  %s --input=somefile.rpm [--output=somefile.d] [--search=somefolder1,somefolder2,...]' % sys.argv[0])
@@ -428,6 +799,13 @@ def usage():
     print('                              Put the given list of filepaths in the output dependency file as explicit')
     print('                              dependencies of the RPM.')
     print('Advanced options:')
+    print('  -c, --checksum-cache=<file.db>')
+    print('                              Store the MD5/SHA256 sums of the files found in the search directories')
+    print('                              in the given database file and reuse them on next runs, so that only files')
+    print('                              modified in the meantime get hashed again. The same file can be shared')
+    print('                              by all RPMs and by parallel invocations of this utility.')
+    print('  -j, --jobs=<N>             Number of files to hash in parallel (default: 4 per CPU, at most 32).')
+    print('                              Hashing runs in threads, since hashlib releases the GIL while digesting.')
     print('  -x, --match-executable-by-name-only')
     print('                              By default the matching between RPM packaged files and file system files is')
     print('                              based on filename and MD5/SHA256 sums. This flag will loosen the match criteria')
@@ -447,10 +825,11 @@ def parse_command_line():
     """Parses the command line
     """
     try:
-        opts, remaining_args = getopt.getopt(sys.argv[1:], "ihvosmdextn", 
+        opts, remaining_args = getopt.getopt(sys.argv[1:], "i:hvo:sm:d:e:xtnc:j:", 
             ["input=", "help", "verbose", "version", "output=", "strict", 
              "dump-missed-files=", "search=", "explicit-dependencies=",
-             "match-executable-by-name-only", "strip-dirname", "no-empty-recipes"])
+             "match-executable-by-name-only", "strip-dirname", "no-empty-recipes",
+             "checksum-cache=", "jobs="])
     except getopt.GetoptError as err:
         # print help information and exit:
         print(str(err))  # will print something like "option -a not recognized"
@@ -463,6 +842,8 @@ def parse_command_line():
     search_dirs = ""
     missed_list_outfile = ""
     explicit_deps = ""
+    checksum_cache = ""
+    jobs = 0
     strict = False
     strip_dirname = False
     generate_empty_recipes = True
@@ -492,12 +873,21 @@ def parse_command_line():
             generate_empty_recipes = False
         elif o in ("-x", "--match-executable-by-name-only"):
             match_exec_by_filename_only = True
+        elif o in ("-c", "--checksum-cache"):
+            checksum_cache = a
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                jobs = -1
+            if jobs < 1:
+                print("Invalid --jobs value '{}': expecting a positive integer".format(a))
+                sys.exit(os.EX_USAGE)
         else:
             assert False, "unhandled option " + o + a
 
     if version:
-        version = pkg_resources.require("rpm_make_rules_dependency_lister")[0].version
-        print("{}".format(version))
+        print("{}".format(get_version()))
         sys.exit(0)
 
     if input_rpm == "":
@@ -518,6 +908,8 @@ def parse_command_line():
             'missed_list_outfile': missed_list_outfile,
             "explicit_dependencies":explicit_deps,
             "generate_empty_recipes":generate_empty_recipes,
+            "checksum_cache":checksum_cache,
+            "jobs":jobs,
             "nameonly_check_for_exec_files":match_exec_by_filename_only }
 
 
@@ -532,6 +924,10 @@ def main():
         sys.exit(1)
 
     config = parse_command_line()
+    if verbose:
+        # verbose mode prints a few lines per packaged file: when stdout is a terminal it is line-buffered
+        # by default, which means one write() syscall per line; let them coalesce in the stdout buffer instead
+        sys.stdout.reconfigure(line_buffering=False)
     
     # adjust list of search directories
     if len(config['search_dirs'])==0:
@@ -22,7 +22,7 @@ with open(path.join(here, 'README.md'), encoding='utf-8') as f:
 setup(
     name='rpm-make-rules-dependency-lister',
     packages=['rpm_make_rules_dependency_lister'],
-    python_requires='>=3',
+    python_requires='>=3.7',
     version='1.11.1',
     description='Module for analyzing RPM dependencies and speedup RPM building process.',
     long_description=long_description,  # Optional